@@ -1,34 +1,71 @@
 ﻿#!/usr/bin/env python3
 """
 music_cli.py — Cliente CLI para Music Daemon
-Dependências: typer, rich, requests
+Dependências: typer, rich, requests, orjson, ijson
 """
 
+import functools
 import subprocess
 import sys
 import time
 import os
-from typing import Optional, List, Dict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import ClassVar, Iterator, Optional, List, Dict, Type
+from urllib.parse import quote
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import typer
-from rich.console import Console
+from rich.console import Console, Group
 from rich.table import Table
 from rich.panel import Panel
-from rich.prompt import Prompt
-from rich.live import Live
+
+# Prompt/Live (e ijson, só do queue-list) são importados sob demanda:
+# comandos simples (pause, resume, next, stop) não pagam o custo de
+# carregá-los. Table/Panel não: o typer já os importa.
 
 app = typer.Typer(help="Cliente CLI para Music Daemon (yt-dlp + mpv)")
 console = Console()
 
 DEFAULT_HOST = "127.0.0.1"
 DEFAULT_PORT = 5000
+CACHE_DIR = Path.home() / ".cache" / "musicd"
+DAEMON_UP_TTL = 30  # segundos sem refazer o health check
+STREAM_MIN_BYTES = 256 * 1024  # respostas maiores são lidas em streaming
+
+
+def _make_session() -> requests.Session:
+    """Cria uma sessão HTTP com pool de conexões keep-alive para o daemon"""
+    session = requests.Session()
+    session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8))
+    return session
+
+
+def _mark_daemon_up(marker: Path):
+    """Registra em disco que o daemon respondeu agora"""
+    try:
+        marker.parent.mkdir(parents=True, exist_ok=True)
+        marker.touch()
+    except OSError:
+        pass  # Sem cache, o próximo comando apenas refaz o health check
 
 
-def ensure_daemon():
+def ensure_daemon(api: "MusicAPI"):
     """Garante que o daemon esteja rodando"""
-    url = f"http://{DEFAULT_HOST}:{DEFAULT_PORT}/status"
+    # Daemon visto há pouco: pula o health check
     try:
-        requests.get(url, timeout=2)
+        if time.time() - api.up_marker.stat().st_mtime < DAEMON_UP_TTL:
+            return
+    except OSError:
+        pass
+    url = f"{api.base_url}/status"
+    try:
+        # Sem o arquivo do socket não há daemon: nem tenta o HTTP
+        if api.sock and not os.path.exists(api.sock):
+            raise FileNotFoundError(api.sock)
+        api._session.get(url, timeout=2)
+        _mark_daemon_up(api.up_marker)
         return
     except Exception:
         console.print("[yellow]🔄 Iniciando daemon...[/yellow]")
@@ -37,14 +74,19 @@ def ensure_daemon():
         subprocess.Popen(
             ["musicd"], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
         )
-        # esperar subir
-        for _ in range(10):
+        # esperar subir: backoff exponencial (50ms, 100ms, ... até 0.5s)
+        # para que um daemon que sobe rápido não custe 1s inteiro
+        delay = 0.05
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
             try:
-                requests.get(url, timeout=2)
+                api._session.get(url, timeout=0.5)
+                _mark_daemon_up(api.up_marker)
                 console.print("[green]✅ Daemon pronto[/green]")
                 return
             except Exception:
-                time.sleep(1)
+                time.sleep(delay)
+                delay = min(delay * 2, 0.5)
         console.print("[red]❌ Falha ao iniciar daemon[/red]")
         raise typer.Exit(1)
 
@@ -53,40 +95,94 @@ def ensure_daemon():
 # Helper: API Client
 # -------------------------------
 class MusicAPI:
+    # Sessão compartilhada: reaproveita a conexão TCP entre as chamadas
+    _session: ClassVar[requests.Session] = _make_session()
+
     def __init__(self, host: Optional[str] = None, port: Optional[int] = None):
         self.host = host or os.getenv("MUSICD_HOST") or DEFAULT_HOST
         self.port = port or int(os.getenv("MUSICD_PORT") or DEFAULT_PORT)
         self.base_url = f"http://{self.host}:{self.port}"
-
-    def post(self, path: str, json: dict = None):  # type: ignore
-        url = f"{self.base_url}{path}"
+        # Daemon local via socket UNIX (MUSICD_SOCK): evita a pilha TCP
+        self.sock = os.getenv("MUSICD_SOCK")
+        if self.sock:
+            import requests_unixsocket
+
+            self._session = requests_unixsocket.Session()
+            self.base_url = f"http+unix://{quote(self.sock, safe='')}"
+        # Marca de "daemon no ar" usada por ensure_daemon (por endereço do daemon)
+        if self.sock:
+            self.up_marker = CACHE_DIR / f"up-sock-{quote(self.sock, safe='')}"
+        else:
+            self.up_marker = CACHE_DIR / f"up-{self.host}-{self.port}"
+
+    @contextmanager
+    def _handle_errors(self, *extra: Type[Exception]) -> Iterator[None]:
+        """Converte falhas ao falar com o daemon em mensagem + saída com erro"""
         try:
-            resp = requests.post(url, json=json or {}, timeout=20)
-            resp.raise_for_status()  # Lança erro para status 4xx/5xx
-            return resp.json()
+            yield
         except requests.exceptions.ConnectionError:
+            self.up_marker.unlink(missing_ok=True)
             console.print(
                 f"[red]❌ Erro: Não foi possível conectar ao daemon em {self.base_url}. Ele está rodando?[/red]"
             )
             raise typer.Exit(1)
-        except requests.exceptions.RequestException as e:
+        except (requests.exceptions.RequestException, orjson.JSONDecodeError, *extra) as e:
             console.print(f"[red]❌ Erro na comunicação com o daemon: {e}[/red]")
             raise typer.Exit(1)
 
+    def post(self, path: str, json: dict = None):  # type: ignore
+        url = f"{self.base_url}{path}"
+        with self._handle_errors():
+            resp = self._session.post(
+                url,
+                data=orjson.dumps(json or {}),
+                headers={"Content-Type": "application/json"},
+                timeout=20,
+            )
+            resp.raise_for_status()  # Lança erro para status 4xx/5xx
+            return orjson.loads(resp.content)
+
     def get(self, path: str, params: dict = None):  # type: ignore
         url = f"{self.base_url}{path}"
-        try:
-            resp = requests.get(url, params=params or {}, timeout=20)
+        with self._handle_errors():
+            resp = self._session.get(url, params=params or {}, timeout=20)
             resp.raise_for_status()
-            return resp.json()
-        except requests.exceptions.ConnectionError:
-            console.print(
-                f"[red]❌ Erro: Não foi possível conectar ao daemon em {self.base_url}. Ele está rodando?[/red]"
-            )
-            raise typer.Exit(1)
-        except requests.exceptions.RequestException as e:
-            console.print(f"[red]❌ Erro na comunicação com o daemon: {e}[/red]")
-            raise typer.Exit(1)
+            return orjson.loads(resp.content)
+
+    def get_items(self, path: str, key: str) -> Iterator[dict]:
+        """Itera a lista `key` da resposta; respostas grandes são lidas em streaming"""
+        import ijson
+        import urllib3
+
+        url = f"{self.base_url}{path}"
+        # resp.raw é lido direto: erros do urllib3 não viram RequestException
+        with self._handle_errors(ijson.JSONError, urllib3.exceptions.HTTPError):
+            with self._session.get(url, stream=True, timeout=20) as resp:
+                resp.raise_for_status()
+                size = int(resp.headers.get("Content-Length") or 0)
+                if size and size < STREAM_MIN_BYTES:
+                    yield from orjson.loads(resp.content).get(key, [])
+                else:
+                    # Entrega cada item assim que chega, sem montar o JSON inteiro
+                    resp.raw.decode_content = True
+                    yield from ijson.items(resp.raw, f"{key}.item", use_float=True)
+
+    def events(self, path: str = "/events") -> Iterator[dict]:
+        """Consome o stream SSE do daemon, gerando um payload por mudança de estado"""
+        url = f"{self.base_url}{path}"
+        with self._handle_errors():
+            # O daemon envia keep-alive a cada 15s, então 30s de leitura basta
+            with self._session.get(url, stream=True, timeout=(5, 30)) as resp:
+                resp.raise_for_status()
+                for line in resp.iter_lines():
+                    if line.startswith(b"data:"):
+                        yield orjson.loads(line[5:])
+
+
+@functools.lru_cache(maxsize=None)
+def _api(host: Optional[str] = None, port: Optional[int] = None) -> MusicAPI:
+    """Instância de MusicAPI (e sua sessão) compartilhada por host/porta"""
+    return MusicAPI(host, port)
 
 
 # -------------------------------
@@ -120,7 +216,7 @@ def main(
 ):
     ctx.obj = {"host": host, "port": port}
     # 🔄 Garante que o daemon esteja rodando antes de qualquer comando
-    ensure_daemon()
+    ensure_daemon(_api(**ctx.obj))
 
 
 @app.command()
@@ -128,7 +224,7 @@ def play(
     ctx: typer.Context, query: str = typer.Argument(..., help="Nome ou URL da música")
 ):
     """Toca música imediatamente"""
-    api = MusicAPI(**ctx.obj)
+    api = _api(**ctx.obj)
     resp = api.post("/play", {"query": query})
     if resp.get("ok"):
         console.print("[green]▶ Tocando agora[/green]")
@@ -138,7 +234,7 @@ def play(
 @app.command()
 def pause(ctx: typer.Context):
     """Pausa reprodução"""
-    api = MusicAPI(**ctx.obj)
+    api = _api(**ctx.obj)
     resp = api.post("/pause")
     if resp.get("ok"):
         console.print("[yellow]⏸ Pausado[/yellow]")
@@ -147,7 +243,7 @@ def pause(ctx: typer.Context):
 @app.command()
 def resume(ctx: typer.Context):
     """Retoma reprodução"""
-    api = MusicAPI(**ctx.obj)
+    api = _api(**ctx.obj)
     resp = api.post("/resume")
     if resp.get("ok"):
         console.print("[green]▶ Resumido[/green]")
@@ -156,7 +252,7 @@ def resume(ctx: typer.Context):
 @app.command()
 def stop(ctx: typer.Context):
     """Para a reprodução atual"""
-    api = MusicAPI(**ctx.obj)
+    api = _api(**ctx.obj)
     resp = api.post("/stop")
     if resp.get("ok"):
         console.print("[red]⏹ Parado[/red]")
@@ -165,7 +261,7 @@ def stop(ctx: typer.Context):
 @app.command()
 def next(ctx: typer.Context):
     """Próxima faixa"""
-    api = MusicAPI(**ctx.obj)
+    api = _api(**ctx.obj)
     resp = api.post("/next")
     if resp.get("ok"):
         console.print("[green]⏭ Próxima faixa[/green]")
@@ -174,14 +270,27 @@ def next(ctx: typer.Context):
 
 @app.command("queue-add")
 def queue_add(
-    ctx: typer.Context, query: str = typer.Argument(..., help="Adicionar música à fila")
+    ctx: typer.Context,
+    queries: List[str] = typer.Argument(..., help="Adicionar música(s) à fila"),
 ):
-    """Adiciona uma música ao final da fila."""
-    api = MusicAPI(**ctx.obj)
-    resp = api.post("/queue", {"query": query})
+    """Adiciona uma ou mais músicas ao final da fila."""
+    api = _api(**ctx.obj)
+    if len(queries) == 1:
+        resp = api.post("/queue", {"query": queries[0]})
+        if resp.get("ok"):
+            console.print("[green]✅ Música adicionada à fila[/green]")
+            pretty_track(resp.get("item"))
+        return
+
+    # Várias músicas: o daemon resolve todas em paralelo numa só chamada
+    resp = api.post("/queue/batch", {"queries": queries})
+    for query in resp.get("missing", []):
+        console.print(f"[red]❌ Não encontrada: {query}[/red]")
     if resp.get("ok"):
-        console.print("[green]✅ Música adicionada à fila[/green]")
-        pretty_track(resp.get("item"))
+        items = resp.get("items", [])
+        console.print(f"[green]✅ {len(items)} música(s) adicionada(s) à fila[/green]")
+        for item in items:
+            pretty_track(item)
 
 
 @app.command()
@@ -190,7 +299,9 @@ def search(
     query: str = typer.Argument(..., help="Pesquisa no YouTube Music"),
 ):
     """Busca por músicas e as adiciona à fila"""
-    api = MusicAPI(**ctx.obj)
+    from rich.prompt import Prompt
+
+    api = _api(**ctx.obj)
     resp = api.post("/search", {"query": query})
     if not resp.get("ok"):
         console.print("[red]❌ Erro na busca.[/red]")
@@ -245,22 +356,31 @@ def search(
 @app.command()
 def monitor(ctx: typer.Context):
     """Monitora o status do reprodutor em tempo real (Ctrl+C para sair)"""
-    api = MusicAPI(**ctx.obj)
+    from rich.live import Live
+    from rich.prompt import Prompt
+
+    api = _api(**ctx.obj)
+    # Último cabeçalho/tabela renderizados, reaproveitados se nada mudou
+    last_now_key, now_output = object(), ""
+    last_queue_sig, queue_table = None, None
     with Live(auto_refresh=False) as live:
         try:
-            while True:
-                resp = api.get("/status")
+            # Redesenha apenas quando o daemon notifica uma mudança de estado
+            for resp in api.events():
                 now = resp.get("now")
                 queue = resp.get("queue", [])
 
                 # Renderiza o status
-                output = ""
-                if now:
-                    output += f"[bold green]▶ Agora tocando[/bold green]\n"
-                    # Aqui você pode usar uma função para formatar a saída
-                    output += f"🎵 [cyan]{now.get('title')}[/cyan]\n   └─ [magenta]{now.get('artist')}[/magenta]\n"
-                else:
-                    output += "[bold dim]⏹ Nada tocando[/bold dim]\n"
+                now_key = now.get("webpage_url") if now else None
+                if now_key != last_now_key:
+                    if now:
+                        now_output = f"[bold green]▶ Agora tocando[/bold green]\n"
+                        # Aqui você pode usar uma função para formatar a saída
+                        now_output += f"🎵 [cyan]{now.get('title')}[/cyan]\n   └─ [magenta]{now.get('artist')}[/magenta]\n"
+                    else:
+                        now_output = "[bold dim]⏹ Nada tocando[/bold dim]\n"
+                    last_now_key = now_key
+                output = now_output
 
                 # Se nada estiver tocando e a fila estiver vazia, pergunta por uma nova música
                 if not now and not queue:
@@ -268,15 +388,21 @@ def monitor(ctx: typer.Context):
                     live.refresh()
                     try:
                         # Pausa o live para não interferir com o prompt
-                        with live.console.capture():
-                            query = Prompt.ask(
-                                "\n[bold yellow]A fila acabou! Qual a próxima música?[/bold yellow] (ou pressione Ctrl+C para sair)"
-                            )
-                        if query:
+                        # Só sai do prompt quando algo começar a tocar, pois
+                        # o daemon não emite eventos enquanto o estado não muda
+                        while True:
+                            with live.console.capture():
+                                query = Prompt.ask(
+                                    "\n[bold yellow]A fila acabou! Qual a próxima música?[/bold yellow] (ou pressione Ctrl+C para sair)"
+                                )
+                            if not query:
+                                continue
                             console.print(f"Tocando '{query}'...")
-                            api.post("/play", {"query": query})
-                            # Continua o loop para atualizar o status
-                            continue
+                            if api.post("/play", {"query": query}).get("ok"):
+                                break
+                            console.print("[red]❌ Música não encontrada.[/red]")
+                        # O próximo evento do daemon atualiza o status
+                        continue
                     except (KeyboardInterrupt, typer.Exit):
                         # Se o usuário cancelar, sai do monitor
                         break
@@ -284,23 +410,28 @@ def monitor(ctx: typer.Context):
                         break  # Sai em caso de outro erro
                 output += f"\n[blue]Tamanho da fila:[/blue] {len(queue)}\n"
 
-                # Formata a fila em uma tabela
-                if queue:
-                    table = Table(title="Fila de reprodução")
-                    table.add_column("#", style="dim", width=4)
-                    table.add_column("Título", style="cyan")
-                    table.add_column("Artista", style="magenta")
-                    for i, t in enumerate(queue, start=1):
-                        table.add_row(
-                            str(i),
-                            t.get("title", "—"),
-                            t.get("artist", t.get("uploader", "—")),
-                        )
-                    output += str(table)
-
-                live.update(output)
+                # Formata a fila em uma tabela (só reconstrói se a fila mudou)
+                queue_sig = tuple(
+                    (t.get("title"), t.get("artist") or t.get("uploader"))
+                    for t in queue
+                )
+                if queue_sig != last_queue_sig:
+                    queue_table = None
+                    if queue:
+                        queue_table = Table(title="Fila de reprodução")
+                        queue_table.add_column("#", style="dim", width=4)
+                        queue_table.add_column("Título", style="cyan")
+                        queue_table.add_column("Artista", style="magenta")
+                        for i, t in enumerate(queue, start=1):
+                            queue_table.add_row(
+                                str(i),
+                                t.get("title", "—"),
+                                t.get("artist", t.get("uploader", "—")),
+                            )
+                    last_queue_sig = queue_sig
+
+                live.update(Group(output, queue_table) if queue_table else output)
                 live.refresh()
-                time.sleep(2)  # Atualiza a cada 2 segundos
         except KeyboardInterrupt:
             console.print("\n[yellow]Saindo do monitor.[/yellow]")
         except typer.Exit:
@@ -311,32 +442,31 @@ def monitor(ctx: typer.Context):
 @app.command("queue-list")
 def queue_list(ctx: typer.Context):
     """Lista a fila de reprodução"""
-    api = MusicAPI(**ctx.obj)
-    resp = api.get("/queue")
-    items: List[Dict] = resp.get("queue", [])
-    if not items:
-        console.print("[dim]Fila vazia[/dim]")
-        return
+    api = _api(**ctx.obj)
     table = Table(title="Fila")
     table.add_column("#", width=4)
     table.add_column("Título")
     table.add_column("Artista")
     table.add_column("Duração", width=10)
-    for i, t in enumerate(items, start=1):
+    # As linhas são montadas conforme os itens chegam do daemon
+    for i, t in enumerate(api.get_items("/queue", "queue"), start=1):
         table.add_row(
             str(i),
             t.get("title", "—"),
             t.get("artist", t.get("uploader", "—")),
             str(t.get("duration_str", t.get("duration", "—"))),
         )
+    if not table.row_count:
+        console.print("[dim]Fila vazia[/dim]")
+        return
     console.print(table)
 
 
 @app.command()
 def status(ctx: typer.Context):
     """Mostra música atual e fila"""
-    api = MusicAPI(**ctx.obj)
-    resp = api.get("/status")
+    api = _api(**ctx.obj)
+    resp = api.get("/state")
     now = resp.get("now")
     queue = resp.get("queue", [])
     if now:
@@ -1,15 +1,29 @@
 ﻿#!/usr/bin/env python3
 """
 musicd.py — Music Daemon com autoplay
-Dependências: fastapi, uvicorn, python-mpv, yt-dlp, httpx
+Dependências: fastapi, uvicorn, python-mpv, yt-dlp, diskcache, orjson, httpx
 """
 
 import os
+import re
+import sys
 import asyncio
-from fastapi import FastAPI
+import functools
+import itertools
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from queue import Empty, SimpleQueue
+from fastapi import FastAPI, Query, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Deque, Dict, List, Optional, Tuple
 from rich.console import Console
+from diskcache import ENOVAL, Cache
+import httpx
+import orjson
 import yt_dlp
 import mpv  # type: ignore
 import uvicorn
@@ -18,15 +32,105 @@ import uvicorn
 # O caminho para a pasta do MPV é adicionado ao PATH do ambiente.
 os.environ["PATH"] = "C:\\mpv" + os.pathsep + os.environ["PATH"]
 
-app = FastAPI(title="Music Daemon (YouTube Music)")
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Liga o fim de faixa do mpv ao autoplay e encerra o player ao desligar."""
+    global player_lock, player_wakeup, state_changed, http_client
+    loop = asyncio.get_running_loop()
+    # Criados aqui, já dentro do loop do uvicorn: no Python 3.8/3.9 Lock e
+    # Event se prendem ao loop corrente na construção
+    player_lock = asyncio.Lock()
+    player_wakeup = asyncio.Event()
+    state_changed = asyncio.Event()
+
+    @player.event_callback("end-file")
+    def on_end_file(event):
+        # Roda na thread de eventos do mpv: repassa para o loop do asyncio
+        reason = getattr(getattr(event, "data", None), "reason", None)
+        loop.call_soon_threadsafe(track_finished, reason == MPV_END_FILE_ERROR)
+
+    http_client = httpx.AsyncClient(
+        http2=True,
+        timeout=5,
+        headers={"User-Agent": BROWSER_UA, "Accept-Language": "en-US,en"},
+        cookies={"SOCS": "CAI"},  # pula a página de consentimento de cookies
+    )
+    task = asyncio.create_task(player_loop())
+    try:
+        yield
+    finally:
+        task.cancel()
+        try:
+            # Não deixa uma falha do player_loop impedir a limpeza abaixo
+            for result in await asyncio.gather(task, return_exceptions=True):
+                if isinstance(result, Exception):
+                    console.log(f"Autoplay: loop terminou com erro: {result!r}")
+            await http_client.aclose()
+        finally:
+            player.terminate()  # Libera o processo/thread do mpv na hora
+
+
+app = FastAPI(
+    title="Music Daemon (YouTube Music)",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 
 console = Console()
 
+HISTORY_MAX = 500
+
 # Estado
-queue: List[dict] = []
-history: List[dict] = []
+queue: Deque[dict] = deque()  # popleft/appendleft em O(1)
+history: Deque[dict] = deque(maxlen=HISTORY_MAX)  # só as últimas faixas
 current_track: Optional[dict] = None
-player_lock = asyncio.Lock()
+# Primitivas do asyncio, criadas no lifespan (None até lá)
+player_lock: Optional[asyncio.Lock] = None
+# Acorda o autoplay: setado no fim de cada faixa e quando a fila recebe músicas
+player_wakeup: Optional[asyncio.Event] = None
+
+# Versão do estado: incrementada a cada mutação de fila/faixa atual.
+# `state_changed` é trocado a cada mutação para acordar quem espera em /events.
+state_version = 0
+state_changed: Optional[asyncio.Event] = None
+# Identifica esta execução do daemon nos ETags (a versão recomeça do zero)
+STATE_EPOCH = f"{time.time_ns():x}"
+
+
+def touch_state():
+    """Marca o estado como alterado e acorda os clientes de /events."""
+    global state_version, state_changed
+    state_version += 1
+    if state_changed is not None:
+        state_changed.set()
+        state_changed = asyncio.Event()
+
+
+def wake_player():
+    """Acorda o player_loop (sem efeito antes do lifespan criar o evento)."""
+    if player_wakeup is not None:
+        player_wakeup.set()
+
+
+def state_etag(*parts) -> str:
+    """ETag derivado da versão do estado (e de parâmetros da resposta)."""
+    return 'W/"' + "-".join(map(str, (STATE_EPOCH, state_version, *parts))) + '"'
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    """Se o cliente já tem esta versão (If-None-Match)."""
+    tags = request.headers.get("if-none-match", "")
+    return etag in (tag.strip() for tag in tags.split(","))
+
+
+def state_snapshot() -> dict:
+    """Estado resumido (faixa atual + fila) usado por /state e /events.
+
+    As respostas levam cópias das listas: o estado só muda no loop do asyncio,
+    então a cópia é feita sem nenhuma mutação no meio.
+    """
+    return {"ok": True, "now": current_track, "queue": list(queue)}
 
 # Player MPV configurado sem vídeo
 player = mpv.MPV(
@@ -35,11 +139,144 @@ player = mpv.MPV(
     osc=False,
     vo="null",  # sem janela de vídeo
     audio_display=False,
-    ytdl=True,  # deixa o mpv lidar com urls do yt
+    ytdl=False,  # recebe URLs diretas de áudio, já resolvidas pelo yt-dlp
     # quiet=True, # Desabilitar para ver logs do mpv/yt-dlp em caso de erro
 )
 
 
+# Cache em disco dos resultados do yt-dlp (cada extração leva segundos)
+ytdl_cache = Cache(os.path.join(os.path.expanduser("~"), ".cache", "musicd", "ytdl"))
+ytdl_cache.stats(enable=True)
+SEARCH_TTL = 24 * 60 * 60  # listas de busca: 1 dia
+TRACK_TTL = 7 * 24 * 60 * 60  # metadados de uma faixa: 7 dias
+MISS_TTL = 60  # buscas sem resultado: absorve novas tentativas imediatas
+
+# Travas por chave do cache (com contagem de usuários, para poder descartá-las)
+key_locks: Dict[tuple, list] = {}
+key_locks_guard = threading.Lock()
+
+
+def normalize_query(query: str) -> str:
+    """Normaliza a busca para a chave do cache (URLs mantêm maiúsculas)."""
+    query = " ".join(query.split())
+    return query if "://" in query else query.lower()
+
+
+def cache_key(kind: str, query: str, *args) -> tuple:
+    """Chave de ytdl_cache para uma busca."""
+    return (kind, normalize_query(query), *args)
+
+
+@contextmanager
+def key_lock(key: tuple):
+    """Serializa as extrações de uma mesma chave entre as threads."""
+    with key_locks_guard:
+        entry = key_locks.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with key_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del key_locks[key]
+
+
+def ytdl_cached(kind: str, expire: int):
+    """Cacheia em disco o resultado de uma busca; resultados vazios valem só MISS_TTL."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(query: str, *args):
+            key = cache_key(kind, query, *args)
+            result = ytdl_cache.get(key, default=ENOVAL)
+            if result is ENOVAL:
+                # Buscas idênticas simultâneas esperam a primeira e usam o resultado dela
+                with key_lock(key):
+                    result = ytdl_cache.get(key, default=ENOVAL)
+                    if result is ENOVAL:
+                        result = func(query, *args)
+                        ytdl_cache.set(key, result, expire=expire if result else MISS_TTL)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+class YDLPool:
+    """Instâncias de YoutubeDL reaproveitadas entre chamadas.
+
+    Criar um YoutubeDL reinicializa extratores, cookies e sessão HTTP; aqui
+    cada instância é reutilizada, mas por uma thread de cada vez, pois o
+    yt-dlp não é thread-safe.
+    """
+
+    def __init__(self, opts: dict):
+        self.opts = opts
+        self._idle: SimpleQueue = SimpleQueue()
+
+    @contextmanager
+    def acquire(self):
+        try:
+            ydl = self._idle.get_nowait()
+        except Empty:
+            ydl = yt_dlp.YoutubeDL(self.opts)  # type: ignore
+        try:
+            yield ydl
+        finally:
+            self._idle.put(ydl)
+
+
+# Opções comuns: só precisamos de título/duração/canal e da URL do áudio,
+# então comentários, legendas e o manifesto DASH não são buscados
+YTDL_BASE_OPTS = {
+    "quiet": True,
+    # Cache do yt-dlp (player JS etc.) em local fixo, reaproveitado entre execuções
+    "cachedir": os.path.join(os.path.expanduser("~"), ".cache", "yt-dlp"),
+    "getcomments": False,
+    "writesubtitles": False,
+    "writeautomaticsub": False,
+    "check_formats": False,
+    "youtube_include_dash_manifest": False,
+}
+
+search_ydl = YDLPool(
+    {
+        **YTDL_BASE_OPTS,
+        "default_search": "ytsearch",
+        # A busca não escolhe formatos; na faixa o HLS fica ligado, pois é
+        # a única fonte de formatos das transmissões ao vivo
+        "youtube_include_hls_manifest": False,
+        # Lista plana: não resolve cada vídeo individualmente (--flat-playlist)
+        "extract_flat": "in_playlist",
+        "skip_download": True,
+    }
+)
+track_ydl = YDLPool(
+    {
+        **YTDL_BASE_OPTS,
+        "format": "bestaudio/best",
+        "noplaylist": True,
+        "default_search": "ytsearch1",
+    }
+)
+
+
+# Threads que completam, em paralelo, entradas da busca plana sem metadados.
+# O limite de workers também evita rajadas de requisições ao YouTube.
+resolve_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix="ytdl-resolve")
+# Threads das extrações pedidas pelos endpoints, fora do loop do asyncio
+extract_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="ytdl")
+
+
+async def run_extract(func, *args):
+    """Roda uma busca bloqueante do yt-dlp no extract_pool."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(extract_pool, func, *args)
+
+
 # Modelo para requests
 class PlayRequest(BaseModel):
     query: str
@@ -49,57 +286,80 @@ class SearchRequest(BaseModel):
     query: str
 
 
+class BatchRequest(BaseModel):
+    queries: List[str]
+
+
 # Função para buscar no YouTube
+@ytdl_cached("search", SEARCH_TTL)
 def search_list(query: str, max_results: int = 10) -> list:
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "quiet": True,
-        "default_search": "ytsearch",
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:  # type: ignore
+    with search_ydl.acquire() as ydl:
         info = ydl.extract_info(f"ytsearch{max_results}:{query}", download=False)
         if not info or "entries" not in info or not info["entries"]:
             return []
 
-        return [
+        results = [
             {
                 "title": entry.get("title"),
-                "webpage_url": entry.get("webpage_url"),
+                "webpage_url": flat_entry_url(entry),
                 "duration": entry.get("duration"),
                 "duration_str": entry.get("duration_string"),
-                "artist": entry.get("uploader"),
+                "artist": entry.get("uploader") or entry.get("channel"),
                 "channel": entry.get("channel"),
-                "thumbnail": entry.get("thumbnail"),
+                "thumbnail": entry.get("thumbnail")
+                or (entry.get("thumbnails") or [{}])[-1].get("url"),
             }
             for entry in info["entries"]
         ]
 
+    # A busca plana às vezes não traz a duração (ex.: estreias): resolve só
+    # essas entradas, todas ao mesmo tempo em vez de uma a uma
+    pending = [
+        (result, resolve_pool.submit(search_youtube, result["webpage_url"]))
+        for result in results
+        if result["duration"] is None
+    ]
+    for result, future in pending:
+        try:
+            track = future.result()
+        except Exception as e:
+            # Uma entrada com erro só fica sem duração, sem derrubar a busca
+            console.log(f"Busca: falha ao completar '{result['webpage_url']}': {e!r}")
+            continue
+        if track:
+            result.update(track)
+    return results
+
+
+def flat_entry_url(entry: dict) -> str:
+    """URL do vídeo de uma entrada plana (que pode trazer só o id em `url`)."""
+    url = entry.get("webpage_url") or entry.get("url") or entry["id"]
+    return url if "://" in url else f"https://youtu.be/{url}"
+
 
 @app.post("/search")
 async def search(req: SearchRequest):
-    results = search_list(req.query)
+    results = await run_extract(search_list, req.query)
     return {"ok": True, "results": results}
 
 
 # Função para buscar no YouTube
+@ytdl_cached("track", TRACK_TTL)
 def search_youtube(query: str) -> Optional[dict]:
-    ydl_opts = {
-        "format": "bestaudio/best",
-        "quiet": True,
-        "noplaylist": True,
-        "default_search": "ytsearch1",
-    }
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:  # type: ignore
+    with track_ydl.acquire() as ydl:
         try:
             info = ydl.extract_info(query, download=False)
             # Pega o primeiro resultado da busca ou do playlist
-            if "entries" in info and info["entries"]:
+            if info and info.get("entries"):
                 info = info["entries"][0]
 
             # Se ainda não for um vídeo válido, retorna None
             if not info or "webpage_url" not in info:
                 return None
 
+            # A extração já trouxe a URL direta do áudio: guarda para tocar
+            if info.get("url"):
+                remember_stream(info["webpage_url"], info["url"])
             return {
                 "title": info.get("title"),
                 "webpage_url": info.get("webpage_url"),
@@ -113,11 +373,177 @@ def search_youtube(query: str) -> Optional[dict]:
             return None
 
 
-# Função que roda o player em thread separada
+# Caminho rápido para URLs de vídeo: lê os metadados direto da página do
+# YouTube, sem passar pelos extratores do yt-dlp
+BROWSER_UA = (
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 "
+    "(KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+)
+VIDEO_URL_RE = re.compile(
+    r"https?://(?:(?:www|m|music)\.)?(?:youtube\.com/watch\?(?:.*&)?v=|youtu\.be/)"
+    r"([\w-]{11})"
+)
+# A página tem ~1 MB: o JSON é localizado nos bytes crus (sem decodificar o
+# HTML) pelo nome da variável, e a regex só roda ancorada a partir dali
+PLAYER_RESPONSE_MARKER = b"ytInitialPlayerResponse"
+PLAYER_RESPONSE_RE = re.compile(
+    rb"\s*=\s*(\{.+?\})\s*;\s*(?:var\s+meta|</script)", re.S
+)
+http_client: Optional[httpx.AsyncClient] = None
+
+
+def format_duration(seconds: Optional[int]) -> Optional[str]:
+    """Duração no formato do yt-dlp (`duration_string`): 3:45, 1:02:03."""
+    if not seconds:
+        return None
+    minutes, secs = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02d}:{secs:02d}" if hours else f"{minutes}:{secs:02d}"
+
+
+def extract_player_response(html: bytes) -> Optional[bytes]:
+    """Recorta o JSON atribuído a ytInitialPlayerResponse na página."""
+    pos = html.find(PLAYER_RESPONSE_MARKER)
+    while pos >= 0:
+        match = PLAYER_RESPONSE_RE.match(html, pos + len(PLAYER_RESPONSE_MARKER))
+        if match:
+            return match.group(1)
+        pos = html.find(PLAYER_RESPONSE_MARKER, pos + 1)
+    return None
+
+
+async def fast_resolve(query: str) -> Optional[dict]:
+    """Metadados de uma URL de vídeo lidos da página; None se não se aplica."""
+    match = VIDEO_URL_RE.match(query.strip())
+    if not match or http_client is None:
+        return None
+    video_id = match.group(1)
+    resp = await http_client.get("https://www.youtube.com/watch", params={"v": video_id})
+    resp.raise_for_status()
+    player_response = extract_player_response(resp.content)
+    if not player_response:
+        return None
+    data = orjson.loads(player_response)
+    # Vídeo privado, bloqueado, com restrição de idade...: fica com o yt-dlp
+    if data.get("playabilityStatus", {}).get("status") != "OK":
+        return None
+    details = data["videoDetails"]
+    duration = int(details.get("lengthSeconds") or 0) or None
+    thumbnails = details.get("thumbnail", {}).get("thumbnails") or [{}]
+    return {
+        "title": details.get("title"),
+        "webpage_url": f"https://www.youtube.com/watch?v={video_id}",
+        "duration": duration,
+        "duration_str": format_duration(duration),
+        "artist": details.get("author"),
+        "channel": details.get("author"),
+        "thumbnail": thumbnails[-1].get("url"),
+    }
+
+
+async def resolve_track(query: str) -> Optional[dict]:
+    """Metadados da faixa: cache, depois o caminho rápido e por fim o yt-dlp."""
+    key = cache_key("track", query)
+    track = ytdl_cache.get(key, default=ENOVAL)
+    if track is not ENOVAL:
+        return track
+    try:
+        track = await fast_resolve(query)
+    except (httpx.HTTPError, ValueError, KeyError) as e:
+        console.log(f"Caminho rápido falhou para '{query}': {e!r}")
+        track = None
+    if track:
+        # Mesma chave do search_youtube: a próxima vez não baixa a página
+        ytdl_cache.set(key, track, expire=TRACK_TTL)
+        return track
+    return await run_extract(search_youtube, query)
+
+
+# URLs diretas de áudio já resolvidas para as próximas faixas:
+# webpage_url -> (momento da resolução, url). As URLs do googlevideo
+# expiram em algumas horas, por isso só valem por STREAM_URL_TTL.
+stream_urls: Dict[str, Tuple[float, str]] = {}
+STREAM_URL_TTL = 60 * 60
+# Pré-resoluções ainda em andamento (webpage_url -> Future da URL direta)
+stream_prefetches: Dict[str, Future] = {}
+
+
+def resolve_stream(webpage_url: str) -> Optional[str]:
+    """URL direta do melhor áudio do vídeo (fora do cache em disco, pois expira)."""
+    with track_ydl.acquire() as ydl:
+        try:
+            info = ydl.extract_info(webpage_url, download=False)
+        except yt_dlp.utils.DownloadError:
+            return None
+    return info.get("url") if info else None
+
+
+def remember_stream(webpage_url: str, url: str):
+    """Guarda a URL direta de uma faixa e descarta as que já expiraram."""
+    now = time.monotonic()
+    for key, (fetched_at, _) in list(stream_urls.items()):
+        if now - fetched_at >= STREAM_URL_TTL:
+            stream_urls.pop(key, None)
+    stream_urls[webpage_url] = (now, url)
+
+
+def prefetch_stream(webpage_url: str) -> Optional[str]:
+    """Resolve, numa thread, a URL direta de uma faixa que vai tocar em breve."""
+    url = resolve_stream(webpage_url)
+    if url:
+        remember_stream(webpage_url, url)
+    return url
+
+
+def prefetch_next():
+    """Dispara a resolução da próxima faixa da fila enquanto a atual toca."""
+    for key, future in list(stream_prefetches.items()):
+        if future.done():
+            del stream_prefetches[key]
+    if not queue:
+        return
+    webpage_url = queue[0]["webpage_url"]
+    # Vários /queue seguidos não disparam a mesma resolução de novo
+    if webpage_url not in stream_urls and webpage_url not in stream_prefetches:
+        stream_prefetches[webpage_url] = extract_pool.submit(prefetch_stream, webpage_url)
+
+
+def stream_url_for(track: dict) -> Optional[str]:
+    """URL direta pré-resolvida da faixa, se ainda válida."""
+    fetched_at, url = stream_urls.pop(track["webpage_url"], (0.0, ""))
+    if url and time.monotonic() - fetched_at < STREAM_URL_TTL:
+        return url
+    return None
+
+
 def play_track(url: str):
-    """Função de bloqueio que toca a música e espera ela terminar."""
+    """Manda o mpv tocar a URL; o fim da faixa chega pelo evento "end-file"."""
     player.play(url)
-    player.wait_for_playback()  # Espera a música terminar
+
+
+MPV_END_FILE_ERROR = 4  # mpv_end_file_reason: MPV_END_FILE_REASON_ERROR
+
+# Faixa que já foi recolocada na fila após falhar (só uma nova tentativa)
+retried_url: Optional[str] = None
+
+
+def track_finished(failed: bool = False):
+    """Chamado no loop quando o mpv encerra uma faixa (fim, stop ou erro)."""
+    global current_track, retried_url
+    # Só o "end-file" limpa a faixa atual: assim o autoplay nunca inicia
+    # uma música antes do mpv ter encerrado a anterior.
+    track, current_track = current_track, None
+    if failed and track is not None and track["webpage_url"] != retried_url:
+        # A URL direta pode ter expirado: volta para a frente da fila e o
+        # play_next resolve uma nova
+        console.log(f"Autoplay: Erro ao tocar '{track['title']}', tentando de novo.")
+        retried_url = track["webpage_url"]
+        queue.appendleft(track)
+    elif not failed:
+        retried_url = None
+    touch_state()
+    console.log("Autoplay: Faixa terminada. Procurando a próxima.")
+    wake_player()
 
 
 # Tocar próxima da fila
@@ -125,43 +551,78 @@ async def play_next():
     """Pega a próxima música da fila e a toca."""
     global current_track
     async with player_lock:
-        if not queue:
-            current_track = None
+        if current_track is not None or not queue:
             return
 
-        current_track = queue.pop(0)
-        history.append(current_track)
+        track = queue[0]
+        url = stream_url_for(track)
+        if not url:
+            # Não foi pré-resolvida: espera a pré-resolução em andamento ou
+            # resolve agora (o mpv roda com ytdl=False)
+            pending = stream_prefetches.pop(track["webpage_url"], None)
+            try:
+                if pending is not None:
+                    url = await asyncio.wrap_future(pending)
+                    stream_urls.pop(track["webpage_url"], None)  # já consumida
+                else:
+                    url = await run_extract(resolve_stream, track["webpage_url"])
+            except Exception as e:
+                # Erro inesperado do extrator: trata como indisponível, senão
+                # a faixa travaria a frente da fila
+                console.log(f"Autoplay: Erro ao resolver '{track['title']}': {e!r}")
+                url = None
+            if not queue or queue[0] is not track:
+                # A fila mudou durante a resolução (/play, /stop): recomeça
+                if url:
+                    remember_stream(track["webpage_url"], url)
+                wake_player()
+                return
+
+        queue.popleft()
+        if not url:
+            console.log(f"Autoplay: Áudio de '{track['title']}' indisponível, pulando.")
+            touch_state()
+            wake_player()
+            return
 
-        console.log(f"Autoplay: Tocando '{current_track['title']}'")
-        # Executa a função de bloqueio em uma thread separada gerenciada pelo asyncio
-        loop = asyncio.get_running_loop()
-        await loop.run_in_executor(None, play_track, current_track["webpage_url"])
+        current_track = track
+        if not history or history[-1] is not track:  # nova tentativa não duplica
+            history.append(track)
+        touch_state()
 
-        # Após a música terminar, o loop principal vai chamar play_next() novamente
-        current_track = None
-        console.log("Autoplay: Faixa terminada. Procurando a próxima.")
+        console.log(f"Autoplay: Tocando '{current_track['title']}'")
+        try:
+            play_track(url)
+        except Exception as e:
+            console.log(f"Autoplay: Falha ao tocar: {e}")
+            track_finished()
+            return
+        prefetch_next()
 
 
 async def player_loop():
-    """Loop principal que gerencia o autoplay."""
-    while True:
-        # Se o player não estiver tocando nada e houver músicas na fila,
-        # e não houver um bloqueio ativo, inicia a próxima música.
-        if not player.playback_time and queue and not player_lock.locked():
-            asyncio.create_task(play_next())
-        await asyncio.sleep(0.5)
-
-
-@app.on_event("startup")
-async def startup_event():
-    """Inicia o loop de autoplay em segundo plano."""
-    asyncio.create_task(player_loop())
+    """Loop principal que gerencia o autoplay, acordado por eventos (sem polling)."""
+    try:
+        while True:
+            await player_wakeup.wait()
+            player_wakeup.clear()
+            try:
+                await play_next()
+            except Exception as e:
+                # Uma falha perde só esta faixa, não o autoplay inteiro
+                console.log(f"Autoplay: Erro inesperado: {e!r}")
+    except asyncio.CancelledError:
+        console.log("Autoplay: encerrado.")
 
 
 # Endpoints
 @app.get("/queue")
-async def get_queue():
-    return {"ok": True, "queue": queue}
+async def get_queue(request: Request, response: Response):
+    etag = state_etag("queue")
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    response.headers["ETag"] = etag
+    return {"ok": True, "queue": list(queue)}
 
 
 @app.post("/pause")
@@ -178,10 +639,11 @@ async def resume():
 
 @app.post("/stop")
 async def stop():
-    global queue, current_track
     queue.clear()  # Limpa a fila
-    player.stop()  # Para a música atual
-    current_track = None
+    stream_urls.clear()
+    stream_prefetches.clear()
+    touch_state()
+    player.stop()  # Para a música atual; o "end-file" limpa a faixa atual
     return {"ok": True}
 
 
@@ -198,11 +660,13 @@ async def next_track():
 
 @app.post("/play")
 async def play(req: PlayRequest):
-    track = search_youtube(req.query)
+    track = await run_extract(search_youtube, req.query)
     if not track:
         return {"ok": False, "error": "Música não encontrada"}
 
-    queue.insert(0, track)
+    queue.appendleft(track)
+    touch_state()
+    wake_player()  # Se nada estiver tocando, o player_loop toca já
     player.stop()  # Interrompe a atual para que o player_loop pegue a nova imediatamente
 
     # O player_loop vai pegar a nova música
@@ -210,22 +674,120 @@ async def play(req: PlayRequest):
     return {"ok": True, "track": track}
 
 
+def enqueue(*tracks: dict):
+    """Adiciona faixas ao fim da fila e avisa o autoplay."""
+    queue.extend(tracks)
+    touch_state()
+    wake_player()
+    if current_track is not None:
+        prefetch_next()
+
+
 @app.post("/queue")
 async def add_queue(req: PlayRequest):
-    track = search_youtube(req.query)
+    track = await resolve_track(req.query)
     if not track:
         return {"ok": False, "error": "Música não encontrada"}
-    queue.append(track)
+    enqueue(track)
     return {"ok": True, "item": track}
 
 
+@app.post("/queue/batch")
+async def add_queue_batch(req: BatchRequest):
+    """Resolve várias músicas em paralelo e as adiciona à fila de uma vez."""
+    tracks = await asyncio.gather(
+        *(resolve_track(query) for query in req.queries)
+    )
+    items = [track for track in tracks if track]
+    missing = [query for query, track in zip(req.queries, tracks) if not track]
+    if not items:
+        return {"ok": False, "error": "Nenhuma música encontrada", "missing": missing}
+    enqueue(*items)
+    return {"ok": True, "items": items, "missing": missing}
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    hits, misses = ytdl_cache.stats()
+    return {"ok": True, "hits": hits, "misses": misses, "size": len(ytdl_cache)}
+
+
+@app.post("/cache/clear")
+async def cache_clear():
+    removed = ytdl_cache.clear()
+    return {"ok": True, "removed": removed}
+
+
+# Último /status serializado: (state_version, limit, corpo JSON)
+status_cache: Tuple[int, Optional[int], bytes] = (-1, None, b"")
+
+
 @app.get("/status")
-async def status():
-    return {"ok": True, "now": current_track, "queue": queue, "history": history}
+async def status(request: Request, limit: Optional[int] = Query(None, ge=0)):
+    """Estado completo; `limit` restringe o histórico às últimas N faixas."""
+    global status_cache
+    etag = state_etag("status", limit)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    version, cached_limit, body = status_cache
+    # Só serializa de novo se o estado mudou desde a última resposta
+    if version != state_version or cached_limit != limit:
+        start = 0 if limit is None else max(0, len(history) - limit)
+        body = orjson.dumps(
+            {
+                "ok": True,
+                "now": current_track,
+                "queue": list(queue),
+                "history": list(itertools.islice(history, start, None)),
+            }
+        )
+        status_cache = (state_version, limit, body)
+    return Response(body, media_type="application/json", headers={"ETag": etag})
+
+
+@app.get("/state")
+async def state():
+    """Faixa atual e fila em uma única resposta."""
+    return state_snapshot()
+
+
+async def event_stream():
+    """Gera eventos SSE com o estado sempre que ele muda."""
+    version = None
+    while True:
+        changed = state_changed
+        if version == state_version:
+            try:
+                await asyncio.wait_for(changed.wait(), timeout=15)
+            except asyncio.TimeoutError:
+                yield b": keep-alive\n\n"  # Mantém a conexão aberta
+                continue
+        version = state_version
+        yield b"data: " + orjson.dumps(state_snapshot()) + b"\n\n"
+
+
+@app.get("/events")
+async def events():
+    """Stream (SSE) do estado do player, enviado a cada mudança."""
+    return StreamingResponse(event_stream(), media_type="text/event-stream")
 
 
 def main():
-    uvicorn.run("musicd:app", host="127.0.0.1", port=5000, reload=False)
+    options = {
+        "reload": os.getenv("MUSICD_DEV") == "1",  # recarga só em desenvolvimento
+        "loop": "asyncio" if sys.platform == "win32" else "uvloop",  # sem uvloop no Windows
+        "http": "httptools",
+        "workers": 1,  # o player mpv é um objeto nativo único
+        # Streams de /events nunca terminam sozinhos: sem um limite, um
+        # `monitor` aberto impede o desligamento (e o player.terminate)
+        "timeout_graceful_shutdown": 3,
+    }
+    sock = os.getenv("MUSICD_SOCK")
+    if sock:
+        # Escuta em um socket UNIX em vez de TCP (ver MusicAPI no cliente)
+        uvicorn.run("musicd:app", uds=sock, **options)
+    else:
+        uvicorn.run("musicd:app", host="127.0.0.1", port=5000, **options)
 
 
 if __name__ == "__main__":